@@ -1,15 +1,17 @@
 import asyncio
 import os
-import json
-from openai import OpenAI
+import orjson
+import hashlib
+import threading
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
-from gym_server import mcp
+from gym_server import mcp, DIRECT_RESPONSE_TAG, DIRECT_RESPONSE_FORMATTERS
 
 # Load environment variables
 load_dotenv()
 
 # Initialize OpenAI Client
-client = OpenAI()
+client = AsyncOpenAI()
 
 SYSTEM_PROMPT = """You are helpful Gym Assistant.
 Use the supplied tools to help users check class schedules, book classes, and cancel bookings.
@@ -18,113 +20,355 @@ If a tool returns an error, explain it to the user.
 Today is Monday 10:00 (Simulated).
 """
 
-async def main():
-    print("Gym Assistant CLI (Type 'quit' to exit)")
-    print("-" * 30)
+# Tool schemas only change when gym_server.py changes, so we keep the
+# converted OpenAI list on disk and reuse it across runs.
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOLS_CACHE_FILE = os.path.join(SCRIPT_DIR, "tools_cache.json")
+
+# Maximum model/tool round trips per user turn before forcing a text reply
+MAX_TOOL_ROUNDS = 5
+
+# Extra argument offered on direct-response tools: the model sets it when the
+# tool output, shown as-is, fully answers the user so no other call is needed.
+FINAL_ANSWER_ARG = "final_answer"
+FINAL_ANSWER_PROPERTY = {
+    "type": "boolean",
+    "description": (
+        "Set to true only if this tool's output, shown to the user "
+        "as-is, fully answers their request and no other tool calls "
+        "are needed (e.g. not when you still have to book a class)."
+    ),
+}
+
+# Part of the tools cache key. Bump it when _build_openai_tools changes how
+# the schemas are converted, so an old tools_cache.json is not reused.
+TOOLS_SCHEMA_VERSION = 1
+
+# In-process memo: {tools_key: openai_tools}
+_OPENAI_TOOLS_CACHE = {}
+
+def _tools_key(mcp_tools_dict):
+    """
+    Hash of the tool names, descriptions, parameters and tags, plus what
+    agent.py adds to the schemas, used to validate the cache.
+    """
+    items = sorted(
+        (
+            name,
+            tool.description or "",
+            getattr(tool, 'parameters', None) or {},
+            sorted(getattr(tool, 'tags', None) or ()),
+        )
+        for name, tool in mcp_tools_dict.items()
+    )
+    agent_side = [TOOLS_SCHEMA_VERSION, FINAL_ANSWER_ARG, FINAL_ANSWER_PROPERTY]
+    return hashlib.sha256(
+        orjson.dumps([agent_side, items], option=orjson.OPT_SORT_KEYS)
+    ).hexdigest()
+
+def _load_tools_cache(key):
+    """Return the cached OpenAI tool list if it matches the given key."""
+    if not os.path.exists(TOOLS_CACHE_FILE):
+        return None
+    try:
+        with open(TOOLS_CACHE_FILE, "rb") as f:
+            cache = orjson.loads(f.read())
+        if cache.get("key") == key and isinstance(cache.get("tools"), list):
+            return cache["tools"]
+    except Exception as e:
+        print(f"Warning: Ignoring tools cache: {e}")
+    return None
+
+def _save_tools_cache(key, openai_tools):
+    """Persist the OpenAI tool list next to agent.py."""
+    try:
+        with open(TOOLS_CACHE_FILE, "wb") as f:
+            f.write(orjson.dumps({"key": key, "tools": openai_tools}, option=orjson.OPT_INDENT_2))
+    except Exception as e:
+        print(f"Warning: Could not save tools cache: {e}")
+
+def _is_direct(tool):
+    """True if the tool is tagged as able to answer the user directly."""
+    return DIRECT_RESPONSE_TAG in (getattr(tool, 'tags', None) or ())
+
+def _build_openai_tools(mcp_tools_dict):
+    """Convert FastMCP tools to the OpenAI format, reusing cached schemas."""
+    key = _tools_key(mcp_tools_dict)
+    if key in _OPENAI_TOOLS_CACHE:
+        return _OPENAI_TOOLS_CACHE[key]
+
+    openai_tools = _load_tools_cache(key)
+    if openai_tools is None:
+        openai_tools = []
+        for name, tool in mcp_tools_dict.items():
+            # FunctionTool usually has 'parameters' as the JSON schema.
+            # We try to retrieve it.
+            # If FastMCP implementation varies, we might need adjustments.
+            try:
+                 # FastMCP 2.0 FunctionTool adaptation
+                 # mcp_tool = tool.to_mcp_tool() -> has inputSchema
+                 mcp_tool_def = tool.to_mcp_tool()
+                 parameters_schema = mcp_tool_def.inputSchema
+            except Exception:
+                 # Fallback if strict access fails, e.g. if parameters is directly available
+                 parameters_schema = getattr(tool, 'parameters', {})
+
+            if _is_direct(tool):
+                parameters_schema = dict(parameters_schema)
+                parameters_schema["properties"] = {
+                    **parameters_schema.get("properties", {}),
+                    FINAL_ANSWER_ARG: FINAL_ANSWER_PROPERTY,
+                }
+
+            openai_tools.append({
+                "type": "function",
+                "function": {
+                    "name": tool.name,
+                    "description": tool.description,
+                    "parameters": parameters_schema
+                }
+            })
+        _save_tools_cache(key, openai_tools)
+
+    _OPENAI_TOOLS_CACHE[key] = openai_tools
+    return openai_tools
+
+async def _stream_completion(**kwargs):
+    """
+    Streams a chat completion, printing content as it arrives.
+    Returns the reassembled assistant message as a dict.
+    """
+    stream = await client.chat.completions.create(stream=True, **kwargs)
+    content_parts = []
+    tool_calls = {}  # {index: tool_call dict}
+
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            if not content_parts:
+                print("Assistant: ", end="", flush=True)
+            content_parts.append(delta.content)
+            print(delta.content, end="", flush=True)
+        # Tool calls arrive in fragments, keyed by their index
+        for tc in delta.tool_calls or []:
+            entry = tool_calls.setdefault(tc.index, {
+                "id": "",
+                "type": "function",
+                "function": {"name": "", "arguments": ""}
+            })
+            if tc.id:
+                entry["id"] = tc.id
+            if tc.function:
+                if tc.function.name:
+                    entry["function"]["name"] += tc.function.name
+                if tc.function.arguments:
+                    entry["function"]["arguments"] += tc.function.arguments
+
+    if content_parts:
+        print()
+
+    message = {"role": "assistant", "content": "".join(content_parts) or None}
+    if tool_calls:
+        message["tool_calls"] = [tool_calls[i] for i in sorted(tool_calls)]
+    return message
+
+def _direct_response(tool_instance, result_obj, result):
+    """
+    Returns the text to show the user directly for tools tagged as direct,
+    or None if the result should go back to the model.
+    """
+    if not _is_direct(tool_instance):
+        return None
+    if result.startswith("Error"):
+        # Let the model explain errors or ask for missing details
+        return None
+    formatter = DIRECT_RESPONSE_FORMATTERS.get(tool_instance.name)
+    structured = getattr(result_obj, 'structured_content', None)
+    if formatter and isinstance(structured, dict) and 'result' in structured:
+        return formatter(structured['result'])
+    return result.strip()
+
+async def _run_tool_call(tool_call, mcp_tools_dict):
+    """
+    Run a single OpenAI tool call against FastMCP.
+    Returns the tool message and, for direct-response tools the model marked
+    as the final answer, the text to show the user.
+    """
+    fn_name = tool_call["function"]["name"]
+    arguments = tool_call["function"]["arguments"] or "{}"
+    direct_text = None
+    
+    try:
+        fn_args = orjson.loads(arguments)
+        if not isinstance(fn_args, dict):
+            raise ValueError("expected a JSON object")
+    except ValueError as e:
+        # Still reply to the call: the other calls of the round must finish,
+        # and OpenAI rejects a tool call that has no tool message.
+        result = f"Error: invalid arguments for {fn_name}: {e}"
+        print(f"[Tool Call] {fn_name}({arguments})")
+        print(f"[Tool Output] {result}")
+        return {"role": "tool", "tool_call_id": tool_call["id"], "content": result}, None
+    
+    # Not a real tool argument, only a hint for the agent
+    final_answer = fn_args.pop(FINAL_ANSWER_ARG, False) is True
+    
+    print(f"[Tool Call] {fn_name}({fn_args})")
+    
+    if fn_name in mcp_tools_dict:
+        tool_instance = mcp_tools_dict[fn_name]
+        # Run the tool
+        # tool.run matches the signature, expects arguments
+        try:
+            # FastMCP FunctionTool.run expects a dictionary 'arguments'
+            result_obj = await tool_instance.run(arguments=fn_args)
+            # Extract text from content list
+            if hasattr(result_obj, 'content') and isinstance(result_obj.content, list):
+                result = "".join(
+                    item.text + "\n"
+                    for item in result_obj.content
+                    if hasattr(item, 'text')
+                )
+            else:
+                result = str(result_obj)
+            if final_answer:
+                direct_text = _direct_response(tool_instance, result_obj, result)
+        except Exception as e:
+            result = str(e)
+    else:
+        result = f"Error: Tool {fn_name} not found."
+    
+    print(f"[Tool Output] {result}")
+    
+    tool_message = {
+        "role": "tool",
+        "tool_call_id": tool_call["id"],
+        "content": str(result)
+    }
+    return tool_message, direct_text
 
+async def _load_tools():
+    """Fetches the FastMCP tools and their OpenAI schemas."""
     # Get tools from FastMCP
     # result is a dict: {name: FunctionTool}
     mcp_tools_dict = await mcp.get_tools()
+    return mcp_tools_dict, _build_openai_tools(mcp_tools_dict)
+
+async def _warm_up():
+    """
+    Opens the OpenAI connection and loads the Google Calendar service ahead
+    of the first turn. Failures are ignored; the real calls will report them.
+    """
+    async def warm_openai():
+        await client.models.list()
+
+    async def warm_calendar():
+        from calendar_service import can_authenticate_silently, get_calendar_service
+        # Only with a usable saved token, never start the OAuth browser flow here
+        if await asyncio.to_thread(can_authenticate_silently):
+            await asyncio.to_thread(get_calendar_service)
+
+    await asyncio.gather(warm_openai(), warm_calendar(), return_exceptions=True)
+
+async def _read_input(prompt):
+    """
+    Reads a line from stdin without blocking the event loop.
     
-    # helper to convert to OpenAI format
-    openai_tools = []
-    for name, tool in mcp_tools_dict.items():
-        # FunctionTool usually has 'parameters' as the JSON schema.
-        # We try to retrieve it.
-        # If FastMCP implementation varies, we might need adjustments.
+    The read runs in a daemon thread rather than asyncio.to_thread: after
+    Ctrl+C the pending input() would otherwise keep asyncio.run waiting for
+    the executor until Enter is pressed.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def deliver(set_outcome, value):
+        if not future.done():
+            set_outcome(value)
+
+    def read():
         try:
-             # FastMCP 2.0 FunctionTool adaptation
-             # Inspecting previously showed 'parameters' might not be a direct attribute?
-             # dir() showed 'schema', 'to_mcp_tool'.
-             # mcp_tool = tool.to_mcp_tool() -> has inputSchema
-             mcp_tool_def = tool.to_mcp_tool()
-             parameters_schema = mcp_tool_def.inputSchema
-        except Exception:
-             # Fallback if strict access fails, e.g. if parameters is directly available
-             parameters_schema = getattr(tool, 'parameters', {})
-
-        openai_tools.append({
-            "type": "function",
-            "function": {
-                "name": tool.name,
-                "description": tool.description,
-                "parameters": parameters_schema
-            }
-        })
+            value, set_outcome = input(prompt), future.set_result
+        except BaseException as e:
+            value, set_outcome = e, future.set_exception
+        try:
+            loop.call_soon_threadsafe(deliver, set_outcome, value)
+        except RuntimeError:
+            # The loop is already closed, nobody is waiting for the line
+            pass
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+async def main():
+    print("Gym Assistant CLI (Type 'quit' to exit)")
+    print("-" * 30)
+
+    # Load tools and warm up connections while the user types the first message
+    tools_task = asyncio.create_task(_load_tools())
+    warm_task = asyncio.create_task(_warm_up())
+    mcp_tools_dict = None
+    openai_tools = None
 
     messages = [{"role": "system", "content": SYSTEM_PROMPT}]
 
     while True:
         try:
-            user_input = input("\nUser: ")
+            user_input = await _read_input("\nUser: ")
             if user_input.lower() in ["quit", "exit"]:
                 break
             
             messages.append({"role": "user", "content": user_input})
 
-            # Call OpenAI
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                tools=openai_tools,
-                tool_choice="auto"
-            )
-
-            assistant_msg = response.choices[0].message
-            messages.append(assistant_msg)
-
-            if assistant_msg.tool_calls:
-                # Handle tool calls
-                for tool_call in assistant_msg.tool_calls:
-                    fn_name = tool_call.function.name
-                    fn_args = json.loads(tool_call.function.arguments)
-                    
-                    print(f"[Tool Call] {fn_name}({fn_args})")
-                    
-                    if fn_name in mcp_tools_dict:
-                        tool_instance = mcp_tools_dict[fn_name]
-                        # Run the tool
-                        # tool.run matches the signature, expects arguments
-                        try:
-                            # FastMCP FunctionTool.run expects a dictionary 'arguments'
-                            result_obj = await tool_instance.run(arguments=fn_args)
-                            # Extract text from content list
-                            result = ""
-                            if hasattr(result_obj, 'content') and isinstance(result_obj.content, list):
-                                for item in result_obj.content:
-                                    if hasattr(item, 'text'):
-                                        result += item.text + "\n"
-                            else:
-                                result = str(result_obj)
-                        except Exception as e:
-                            result = str(e)
-                    else:
-                        result = f"Error: Tool {fn_name} not found."
-                    
-                    print(f"[Tool Output] {result}")
-                    
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": str(result)
-                    })
-                
-                # Get final response after tool outputs
-                response_final = client.chat.completions.create(
+            if mcp_tools_dict is None:
+                try:
+                    mcp_tools_dict, openai_tools = await tools_task
+                except Exception:
+                    # Retry on the next turn
+                    tools_task = asyncio.create_task(_load_tools())
+                    raise
+
+            # Call OpenAI (streamed, so text shows up as it is generated).
+            # Tools stay available after tool outputs so the model can chain
+            # calls (e.g. list, then book) within the same turn.
+            for round_num in range(MAX_TOOL_ROUNDS + 1):
+                assistant_msg = await _stream_completion(
                     model="gpt-4o",
-                    messages=messages
+                    messages=messages,
+                    tools=openai_tools,
+                    # Force a text answer once the round limit is reached
+                    tool_choice="auto" if round_num < MAX_TOOL_ROUNDS else "none",
+                    parallel_tool_calls=True
                 )
-                final_msg = response_final.choices[0].message
-                messages.append(final_msg)
-                print(f"Assistant: {final_msg.content}")
+                messages.append(assistant_msg)
 
-            else:
-                print(f"Assistant: {assistant_msg.content}")
+                if not assistant_msg.get("tool_calls"):
+                    break
 
-        except KeyboardInterrupt:
+                # Handle tool calls concurrently, keeping results in call order
+                tool_results = await asyncio.gather(*(
+                    _run_tool_call(tool_call, mcp_tools_dict)
+                    for tool_call in assistant_msg["tool_calls"]
+                ))
+                messages.extend(tool_message for tool_message, _ in tool_results)
+
+                # A single direct-response call that the model marked as the
+                # whole answer to the user's request: skip the follow-up LLM call.
+                # Later rounds are part of a chain and always go back to the model.
+                if round_num == 0 and len(tool_results) == 1 and tool_results[0][1] is not None:
+                    direct_text = tool_results[0][1]
+                    print(f"Assistant: {direct_text}")
+                    messages.append({"role": "assistant", "content": direct_text})
+                    break
+
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            # Under asyncio.run, Ctrl+C arrives as a cancellation of main()
             break
         except Exception as e:
             print(f"Error: {e}")
 
+    warm_task.cancel()
+
 if __name__ == "__main__":
     asyncio.run(main())
@@ -3,12 +3,17 @@ Google Calendar Service Module
 Handles OAuth authentication and calendar operations
 """
 import os
+import json
 import datetime
+import threading
+import httplib2
+import google_auth_httplib2
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/calendar']
@@ -18,10 +23,73 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 CREDENTIALS_FILE = os.path.join(SCRIPT_DIR, 'credentials.json')
 TOKEN_FILE = os.path.join(SCRIPT_DIR, 'token.json')
 
-def get_calendar_service():
+# Cached credentials and Calendar service, shared by all calls.
+# Tokens are refreshed in the background shortly before they expire.
+_CREDS = None
+_SERVICE = None
+_SERVICE_LOCK = threading.RLock()
+_REFRESH_TIMER = None
+# True while a background refresh is running, so only one runs at a time
+_REFRESH_IN_FLIGHT = False
+
+# httplib2.Http is not thread-safe, and calendar calls run in worker threads,
+# so each thread keeps its own keep-alive connection instead of opening a new
+# one (and a new TLS session) per call.
+_HTTP_LOCAL = threading.local()
+HTTP_TIMEOUT = 30
+
+# Day names (English and Spanish) to weekday numbers
+_DAYS = {
+    'monday': 0, 'tuesday': 1, 'wednesday': 2,
+    'thursday': 3, 'friday': 4, 'saturday': 5, 'sunday': 6,
+    'lunes': 0, 'martes': 1, 'miércoles': 2, 'miercoles': 2,
+    'jueves': 3, 'viernes': 4, 'sábado': 5, 'sabado': 5, 'domingo': 6
+}
+
+# _NEXT_OCCURRENCE[today][target]: days until the next target weekday (1-7,
+# a class on today's weekday is booked for next week)
+_NEXT_OCCURRENCE = [[((t - c) % 7) or 7 for t in range(7)] for c in range(7)]
+
+# A token is "stale" (refreshed in the background) this long before expiry
+STALE_WINDOW = datetime.timedelta(minutes=5)
+
+
+def _utcnow_naive():
+    """Current UTC time as a naive datetime, matching google-auth's expiry."""
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def _now_z():
+    """Current UTC time in RFC 3339 format, as expected by the Calendar API."""
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _parse_time(time):
+    """Parses 'HH:MM' into (hour, minute), accepting 'H:MM' as well."""
+    if len(time) == 5 and time[2] == ':':
+        return int(time[:2]), int(time[3:5])
+    hour, minute = time.split(':')
+    return int(hour), int(minute)
+
+
+def _token_state(creds):
+    """Returns 'fresh', 'stale' or 'expired' for the given credentials."""
+    if not creds.token or creds.expired:
+        return 'expired'
+    if creds.expiry and creds.expiry - _utcnow_naive() <= STALE_WINDOW:
+        return 'stale'
+    return 'fresh'
+
+
+def _save_token(creds):
+    """Save the credentials for next time."""
+    with open(TOKEN_FILE, 'w') as token:
+        token.write(creds.to_json())
+
+
+def _load_credentials():
     """
-    Gets an authenticated Google Calendar service.
-    Handles OAuth flow if needed.
+    Loads saved credentials, refreshing them or running the OAuth flow if needed.
     """
     creds = None
     
@@ -42,12 +110,120 @@ def get_calendar_service():
             flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
             creds = flow.run_local_server(port=0)
         
-        # Save the credentials for next time
-        with open(TOKEN_FILE, 'w') as token:
-            token.write(creds.to_json())
+        _save_token(creds)
     
-    service = build('calendar', 'v3', credentials=creds)
-    return service
+    return creds
+
+
+def can_authenticate_silently():
+    """
+    Returns True if the saved token can be used or refreshed without
+    starting the browser OAuth flow (mirrors _load_credentials).
+    """
+    if not os.path.exists(TOKEN_FILE):
+        return False
+    try:
+        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+    except Exception:
+        return False
+    return creds.valid or bool(creds.expired and creds.refresh_token)
+
+
+def _refresh_credentials():
+    """
+    Refreshes the cached credentials in the background.
+    
+    The network call is made on a copy without holding _SERVICE_LOCK, so
+    requests keep using the current (still valid) token meanwhile; the
+    refreshed copy is swapped in afterwards.
+    """
+    global _CREDS, _REFRESH_IN_FLIGHT
+    with _SERVICE_LOCK:
+        if _REFRESH_IN_FLIGHT or _CREDS is None or _token_state(_CREDS) == 'fresh':
+            return
+        _REFRESH_IN_FLIGHT = True
+        current = _CREDS
+    try:
+        # Inside the try, so a token that cannot be copied still clears the flag
+        new_creds = Credentials.from_authorized_user_info(json.loads(current.to_json()), SCOPES)
+        new_creds.refresh(Request())
+        with _SERVICE_LOCK:
+            # Skip the swap if the credentials were replaced meanwhile
+            if _CREDS is current:
+                _CREDS = new_creds
+                _save_token(new_creds)
+                _schedule_refresh(new_creds)
+    except Exception as e:
+        print(f"Warning: Could not refresh Google token: {e}")
+    finally:
+        with _SERVICE_LOCK:
+            _REFRESH_IN_FLIGHT = False
+
+
+def _schedule_refresh(creds):
+    """Starts a background timer that refreshes the token when it becomes stale."""
+    global _REFRESH_TIMER
+    if _REFRESH_TIMER is not None:
+        _REFRESH_TIMER.cancel()
+        _REFRESH_TIMER = None
+    if not creds.expiry or not creds.refresh_token:
+        return
+    delay = (creds.expiry - STALE_WINDOW - _utcnow_naive()).total_seconds()
+    _REFRESH_TIMER = threading.Timer(max(delay, 0), _refresh_credentials)
+    _REFRESH_TIMER.daemon = True
+    _REFRESH_TIMER.start()
+
+
+def _thread_http():
+    """Returns this thread's authorized HTTP client, creating it if needed."""
+    http = getattr(_HTTP_LOCAL, 'http', None)
+    if http is None or http.credentials is not _CREDS:
+        http = google_auth_httplib2.AuthorizedHttp(
+            _CREDS, http=httplib2.Http(timeout=HTTP_TIMEOUT)
+        )
+        _HTTP_LOCAL.http = http
+    return http
+
+
+def _build_request(http, *args, **kwargs):
+    """requestBuilder that sends each API request over the calling thread's connection."""
+    return HttpRequest(_thread_http(), *args, **kwargs)
+
+
+def get_calendar_service():
+    """
+    Gets an authenticated Google Calendar service.
+    Handles OAuth flow if needed.
+    
+    The service is built once and cached. Stale tokens are refreshed in the
+    background; only an already expired token is refreshed inline.
+    """
+    global _CREDS, _SERVICE
+    with _SERVICE_LOCK:
+        if _SERVICE is None:
+            _CREDS = _load_credentials()
+            _SERVICE = build(
+                'calendar', 'v3',
+                http=_thread_http(),
+                requestBuilder=_build_request,
+                cache_discovery=False,
+                static_discovery=True
+            )
+            _schedule_refresh(_CREDS)
+            return _SERVICE
+        
+        state = _token_state(_CREDS)
+        if state == 'expired':
+            if not _CREDS.refresh_token:
+                # Cannot refresh, go through the full OAuth flow again
+                _SERVICE = None
+                return get_calendar_service()
+            _CREDS.refresh(Request())
+            _save_token(_CREDS)
+            _schedule_refresh(_CREDS)
+        elif state == 'stale' and not _REFRESH_IN_FLIGHT:
+            threading.Thread(target=_refresh_credentials, daemon=True).start()
+        return _SERVICE
 
 
 def list_upcoming_events(max_results=10):
@@ -57,7 +233,7 @@ def list_upcoming_events(max_results=10):
     """
     try:
         service = get_calendar_service()
-        now = datetime.datetime.utcnow().isoformat() + 'Z'
+        now = _now_z()
         
         events_result = service.events().list(
             calendarId='primary',
@@ -72,7 +248,7 @@ def list_upcoming_events(max_results=10):
         if not events:
             return "No upcoming events found."
         
-        result = "Upcoming events:\n"
+        lines = ["Upcoming events:"]
         for event in events:
             start = event['start'].get('dateTime', event['start'].get('date'))
             # Parse and format the date
@@ -81,9 +257,9 @@ def list_upcoming_events(max_results=10):
                 formatted_date = dt.strftime('%A %d/%m %H:%M')
             else:
                 formatted_date = start
-            result += f"- {event['summary']} ({formatted_date})\n"
+            lines.append(f"- {event['summary']} ({formatted_date})")
         
-        return result
+        return "\n".join(lines) + "\n"
         
     except HttpError as error:
         return f"Error accessing calendar: {error}"
@@ -109,23 +285,14 @@ def create_calendar_event(title, day, time, duration_hours=1, description=""):
         service = get_calendar_service()
         
         # Convert day name to next occurrence
-        days = {
-            'monday': 0, 'tuesday': 1, 'wednesday': 2,
-            'thursday': 3, 'friday': 4, 'saturday': 5, 'sunday': 6,
-            'lunes': 0, 'martes': 1, 'miércoles': 2, 'miercoles': 2,
-            'jueves': 3, 'viernes': 4, 'sábado': 5, 'sabado': 5, 'domingo': 6
-        }
-        
         today = datetime.date.today()
-        target_day = days.get(day.lower(), 0)
-        days_ahead = target_day - today.weekday()
-        if days_ahead <= 0:
-            days_ahead += 7
+        target_day = _DAYS.get(day.lower(), 0)
+        days_ahead = _NEXT_OCCURRENCE[today.weekday()][target_day]
         
         event_date = today + datetime.timedelta(days=days_ahead)
         
         # Parse time
-        hour, minute = map(int, time.split(':'))
+        hour, minute = _parse_time(time)
         start_datetime = datetime.datetime(
             event_date.year, event_date.month, event_date.day,
             hour, minute
@@ -154,19 +321,21 @@ def create_calendar_event(title, day, time, duration_hours=1, description=""):
         return f"Error: {e}"
 
 
-def delete_event_by_title(title_contains):
+def delete_event_by_title(title_contains, delete_all=False):
     """
-    Deletes an event that contains the given text in its title.
+    Deletes the first upcoming event that contains the given text in its title.
     
     Args:
         title_contains: Text to search for in event titles
+        delete_all: Delete every matching event instead of only the first one.
+            The deletes are sent together in a single batch request.
     
     Returns:
         Success or error message
     """
     try:
         service = get_calendar_service()
-        now = datetime.datetime.utcnow().isoformat() + 'Z'
+        now = _now_z()
         
         events_result = service.events().list(
             calendarId='primary',
@@ -177,16 +346,45 @@ def delete_event_by_title(title_contains):
         ).execute()
         
         events = events_result.get('items', [])
+        needle = title_contains.lower()
+        matches = [e for e in events if needle in e.get('summary', '').lower()]
         
-        for event in events:
-            if title_contains.lower() in event.get('summary', '').lower():
-                service.events().delete(
-                    calendarId='primary',
-                    eventId=event['id']
-                ).execute()
-                return f"Deleted event: {event['summary']}"
-        
-        return f"No event found containing '{title_contains}'"
+        if not matches:
+            return f"No event found containing '{title_contains}'"
+        
+        if not delete_all:
+            event = matches[0]
+            service.events().delete(
+                calendarId='primary',
+                eventId=event['id']
+            ).execute()
+            return f"Deleted event: {event['summary']}"
+        
+        deleted = []
+        failed = []
+        
+        def _on_done(request_id, response, exception):
+            event = matches[int(request_id)]
+            if exception is None:
+                deleted.append(event['summary'])
+            else:
+                failed.append(f"{event['summary']} ({exception})")
+        
+        batch = service.new_batch_http_request(callback=_on_done)
+        for i, event in enumerate(matches):
+            batch.add(
+                service.events().delete(calendarId='primary', eventId=event['id']),
+                request_id=str(i)
+            )
+        batch.execute()
+        
+        lines = []
+        if deleted:
+            label = "events" if len(deleted) > 1 else "event"
+            lines.append(f"Deleted {label}: {', '.join(deleted)}")
+        if failed:
+            lines.append(f"Error deleting event: {', '.join(failed)}")
+        return "\n".join(lines)
         
     except HttpError as error:
         return f"Error deleting event: {error}"
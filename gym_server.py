@@ -1,56 +1,248 @@
 from fastmcp import FastMCP
-import json
+import asyncio
+import atexit
+import orjson
 import os
+import tempfile
+import threading
+import pydantic_core
+from pydantic import BaseModel
+
+
+class ClassSlot(BaseModel):
+    """A gym class as returned by list_classes."""
+    class_name: str
+    day: str
+    time: str
+    slots_left: int
+
+
+def _serialize_tool_result(data):
+    """Serialize non-string tool results to JSON text with orjson."""
+    return orjson.dumps(
+        data,
+        default=pydantic_core.to_jsonable_python,
+        option=orjson.OPT_NON_STR_KEYS
+    ).decode()
+
 
 # Initialize FastMCP server
-mcp = FastMCP("GymAssistant")
+mcp = FastMCP("GymAssistant", tool_serializer=_serialize_tool_result)
+
+# Tools tagged with DIRECT_RESPONSE_TAG return output that is already fit to
+# show the user, so the agent can skip the follow-up LLM call. Tools with
+# structured output register a formatter in DIRECT_RESPONSE_FORMATTERS.
+DIRECT_RESPONSE_TAG = "direct"
+DIRECT_RESPONSE_FORMATTERS = {}
 
 # Use absolute path based on script location
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_FILE = os.path.join(SCRIPT_DIR, "bookings.json")
 
-def load_data():
-    """Load booking data from JSON file with error handling."""
+# Changes are saved as one atomic snapshot at most this often (seconds), so a
+# burst of bookings costs one write instead of one per change.
+# _PENDING holds the changes not yet on disk as (op, index, class_name, user_name),
+# so they can be re-applied if bookings.json is changed by someone else meanwhile.
+FLUSH_INTERVAL = 0.05
+# If a save fails, it is retried after this long (seconds)
+FLUSH_RETRY_INTERVAL = 5
+_PENDING = []
+_FLUSH_TIMER = None
+
+# In-memory copy of bookings.json, reloaded only when the file changes on disk.
+# Hold _DATA_LOCK around any read-modify-write of the data.
+_DATA = None
+_DATA_STAMP = None
+_DATA_LOCK = threading.RLock()
+
+# Lookup indexes over _DATA, rebuilt whenever the data is (re)loaded:
+# _BY_CLASS: {lowercase class_name: index of the first matching class}
+# _BY_USER:  {user_name: set of indexes of classes the user is booked for}
+_BY_CLASS = {}
+_BY_USER = {}
+
+def _file_stamp():
+    """Return (mtime, size) of the data file, or None if it does not exist."""
+    try:
+        st = os.stat(DATA_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _read_data_file():
+    """Read booking data from JSON file with error handling."""
     if not os.path.exists(DATA_FILE):
         return []
     try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        with open(DATA_FILE, "rb") as f:
+            data = orjson.loads(f.read())
             # Validate data structure
             if not isinstance(data, list):
                 print(f"Warning: Invalid data format in {DATA_FILE}, resetting to empty list")
                 return []
             return data
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         print(f"Warning: JSON decode error in {DATA_FILE}: {e}")
         return []
     except Exception as e:
         print(f"Warning: Error loading data: {e}")
         return []
 
+def _build_indexes(data):
+    """Rebuild the class and user lookup indexes for the given data."""
+    global _BY_CLASS, _BY_USER
+    by_class = {}
+    by_user = {}
+    for i, c in enumerate(data):
+        if not isinstance(c, dict):
+            continue
+        name = c.get('class_name')
+        if isinstance(name, str):
+            # Keep the first match, as the old linear scan did
+            by_class.setdefault(name.lower(), i)
+        for user in c.get('booked_by', []):
+            by_user.setdefault(user, set()).add(i)
+    _BY_CLASS = by_class
+    _BY_USER = by_user
+
+def _apply_change(data, change):
+    """Re-apply a pending 'book' or 'cancel' change to freshly loaded data."""
+    op, i, class_name, user_name = change
+    if not (0 <= i < len(data) and isinstance(data[i], dict)
+            and data[i].get('class_name') == class_name):
+        # The class moved, fall back to the first class with that name
+        i = _BY_CLASS.get(class_name.lower())
+        if i is None:
+            return
+    booked_by = data[i].setdefault('booked_by', [])
+    if op == 'book' and user_name not in booked_by:
+        if len(booked_by) >= data[i].get('slots', 0):
+            # Filled up by someone else before our booking was saved
+            print(f"Warning: Dropping booking of {class_name} for {user_name}, the class is full")
+            return
+        booked_by.append(user_name)
+    elif op == 'cancel' and user_name in booked_by:
+        booked_by.remove(user_name)
+
+def _schedule_flush(delay):
+    """Start the flush timer, unless a flush is already scheduled."""
+    global _FLUSH_TIMER
+    with _DATA_LOCK:
+        if _FLUSH_TIMER is None:
+            _FLUSH_TIMER = threading.Timer(delay, flush_changes)
+            _FLUSH_TIMER.daemon = True
+            _FLUSH_TIMER.start()
+
+def _log_change(op, index, user_name):
+    """Record a change to the in-memory data and schedule a save."""
+    with _DATA_LOCK:
+        _PENDING.append((op, index, _DATA[index]['class_name'], user_name))
+        _schedule_flush(FLUSH_INTERVAL)
+
+def flush_changes():
+    """Save the in-memory data to disk if it has unsaved changes."""
+    global _FLUSH_TIMER
+    with _DATA_LOCK:
+        _FLUSH_TIMER = None
+        if not _PENDING:
+            return
+        # Pick up (and keep) changes made by another process first
+        data = load_data()
+        save_data(data)
+        if _PENDING:
+            # The save failed, keep the changes and try again later
+            _schedule_flush(FLUSH_RETRY_INTERVAL)
+
+# Don't lose changes still waiting for the flush timer
+atexit.register(flush_changes)
+
+def load_data():
+    """Return the cached booking data, reloading it if the file was edited externally.
+
+    Changes not yet saved are re-applied on top of the reloaded data.
+    """
+    global _DATA, _DATA_STAMP
+    with _DATA_LOCK:
+        stamp = _file_stamp()
+        if _DATA is None or stamp != _DATA_STAMP:
+            _DATA = _read_data_file()
+            _DATA_STAMP = stamp
+            _build_indexes(_DATA)
+            if _PENDING:
+                for change in _PENDING:
+                    _apply_change(_DATA, change)
+                _build_indexes(_DATA)
+        return _DATA
+
+def find_class_index(class_name):
+    """Return the index of the class with the given name (case-insensitive), or None.
+
+    Stored names are lowercased once when the index is built, so only the
+    requested name is normalized here.
+    """
+    load_data()
+    return _BY_CLASS.get(class_name.strip().lower())
+
 def save_data(data):
-    """Save booking data to JSON file."""
-    try:
-        with open(DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-    except Exception as e:
-        print(f"Error saving data: {e}")
+    """Save booking data to JSON file atomically and refresh the cache."""
+    global _DATA, _DATA_STAMP
+    with _DATA_LOCK:
+        tmp_file = None
+        try:
+            # A unique temp file per write, so another process saving at the
+            # same time cannot interleave its writes with ours
+            fd, tmp_file = tempfile.mkstemp(
+                dir=SCRIPT_DIR, prefix="bookings.json.", suffix=".tmp"
+            )
+            with os.fdopen(fd, "wb") as f:
+                f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+                # Make sure the snapshot is on disk before it replaces the old
+                # file, or a crash could leave an empty bookings.json behind
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, DATA_FILE)
+            tmp_file = None
+            if data is not _DATA:
+                _DATA = data
+                _build_indexes(data)
+            _DATA_STAMP = _file_stamp()
+            # The snapshot now includes every pending change
+            _PENDING.clear()
+        except Exception as e:
+            print(f"Error saving data: {e}")
+            if tmp_file is not None:
+                try:
+                    os.remove(tmp_file)
+                except OSError:
+                    pass
 
-@mcp.tool()
-def list_classes() -> str:
-    """Lists all available gym classes with their details."""
+@mcp.tool(tags={DIRECT_RESPONSE_TAG})
+def list_classes() -> list[ClassSlot]:
+    """Lists all available gym classes with their details (name, day, time and slots left)."""
     data = load_data()
-    if not data:
-        return "No classes available."
-    
-    result = "Available Classes:\n"
+    classes = []
     for c in data:
         try:
-            slots_left = c['slots'] - len(c['booked_by'])
-            result += f"- {c['class_name']} ({c['day']} {c['time']}): {slots_left} slots left\n"
+            classes.append(ClassSlot(
+                class_name=c['class_name'],
+                day=c['day'],
+                time=c['time'],
+                slots_left=c['slots'] - len(c['booked_by']),
+            ))
         except KeyError as e:
-            result += f"- [Invalid class data: missing {e}]\n"
-    return result
+            print(f"Warning: Skipping invalid class data: missing {e}")
+    return classes
+
+def format_classes(classes):
+    """Render list_classes output as text for the user."""
+    if not classes:
+        return "No classes available."
+    lines = ["Available Classes:"]
+    for c in classes:
+        lines.append(f"- {c['class_name']} ({c['day']} {c['time']}): {c['slots_left']} slots left")
+    return "\n".join(lines)
+
+DIRECT_RESPONSE_FORMATTERS["list_classes"] = format_classes
 
 @mcp.tool()
 def book_class(class_name: str, user_name: str) -> str:
@@ -69,19 +261,23 @@ def book_class(class_name: str, user_name: str) -> str:
     class_name = class_name.strip()
     user_name = user_name.strip()
     
-    data = load_data()
-    for c in data:
-        if c['class_name'].lower() == class_name.lower():
-            if user_name in c['booked_by']:
-                return f"{user_name} is already booked for {c['class_name']}."
-            
-            if len(c['booked_by']) < c['slots']:
-                c['booked_by'].append(user_name)
-                save_data(data)
-                return f"Successfully booked {c['class_name']} for {user_name}."
-            else:
-                return f"Sorry, {c['class_name']} is full."
-    return f"Class '{class_name}' not found."
+    with _DATA_LOCK:
+        i = find_class_index(class_name)
+        if i is None:
+            return f"Class '{class_name}' not found."
+        
+        data = load_data()
+        c = data[i]
+        if i in _BY_USER.get(user_name, ()):
+            return f"{user_name} is already booked for {c['class_name']}."
+        
+        if len(c['booked_by']) < c['slots']:
+            c['booked_by'].append(user_name)
+            _BY_USER.setdefault(user_name, set()).add(i)
+            _log_change('book', i, user_name)
+            return f"Successfully booked {c['class_name']} for {user_name}."
+        else:
+            return f"Sorry, {c['class_name']} is full."
 
 @mcp.tool()
 def cancel_booking(class_name: str, user_name: str) -> str:
@@ -100,18 +296,23 @@ def cancel_booking(class_name: str, user_name: str) -> str:
     class_name = class_name.strip()
     user_name = user_name.strip()
     
-    data = load_data()
-    for c in data:
-        if c['class_name'].lower() == class_name.lower():
-            if user_name in c['booked_by']:
-                c['booked_by'].remove(user_name)
-                save_data(data)
-                return f"Booking cancelled for {user_name} in {c['class_name']}."
-            else:
-                return f"{user_name} does not have a booking for {c['class_name']}."
-    return f"Class '{class_name}' not found."
+    with _DATA_LOCK:
+        i = find_class_index(class_name)
+        if i is None:
+            return f"Class '{class_name}' not found."
+        
+        data = load_data()
+        c = data[i]
+        user_classes = _BY_USER.get(user_name, set())
+        if i in user_classes:
+            c['booked_by'].remove(user_name)
+            user_classes.discard(i)
+            _log_change('cancel', i, user_name)
+            return f"Booking cancelled for {user_name} in {c['class_name']}."
+        else:
+            return f"{user_name} does not have a booking for {c['class_name']}."
 
-@mcp.tool()
+@mcp.tool(tags={DIRECT_RESPONSE_TAG})
 def get_my_bookings(user_name: str) -> str:
     """Gets all bookings for a specific user.
     
@@ -122,11 +323,14 @@ def get_my_bookings(user_name: str) -> str:
         return "Error: User name cannot be empty."
     
     user_name = user_name.strip()
-    data = load_data()
     bookings = []
     
-    for c in data:
-        if user_name in c['booked_by']:
+    # The flush thread may reload the data and rebuild the indexes, so read
+    # both under the lock to keep them consistent
+    with _DATA_LOCK:
+        data = load_data()
+        for i in sorted(_BY_USER.get(user_name, ())):
+            c = data[i]
             bookings.append(f"- {c['class_name']} ({c['day']} {c['time']})")
     
     if bookings:
@@ -137,9 +341,11 @@ def get_my_bookings(user_name: str) -> str:
 # ============================================
 # Google Calendar Integration Tools
 # ============================================
+# The Google API client is synchronous, so calendar calls run in a worker
+# thread to avoid stalling other tool calls on the server's event loop.
 
 @mcp.tool()
-def view_calendar(max_events: int = 5) -> str:
+async def view_calendar(max_events: int = 5) -> str:
     """Shows upcoming events from your Google Calendar.
     
     Args:
@@ -147,12 +353,12 @@ def view_calendar(max_events: int = 5) -> str:
     """
     try:
         from calendar_service import list_upcoming_events
-        return list_upcoming_events(max_events)
+        return await asyncio.to_thread(list_upcoming_events, max_events)
     except Exception as e:
         return f"Error accessing calendar: {e}"
 
 @mcp.tool()
-def add_class_to_calendar(class_name: str, user_name: str) -> str:
+async def add_class_to_calendar(class_name: str, user_name: str) -> str:
     """Adds a booked gym class to Google Calendar.
     
     Args:
@@ -160,19 +366,15 @@ def add_class_to_calendar(class_name: str, user_name: str) -> str:
         user_name: Name of the user
     """
     # First find the class details
-    data = load_data()
-    target_class = None
-    for c in data:
-        if c['class_name'].lower() == class_name.lower():
-            target_class = c
-            break
-    
-    if not target_class:
+    i = find_class_index(class_name)
+    if i is None:
         return f"Class '{class_name}' not found."
+    target_class = load_data()[i]
     
     try:
         from calendar_service import create_calendar_event
-        result = create_calendar_event(
+        result = await asyncio.to_thread(
+            create_calendar_event,
             title=f"Gym: {target_class['class_name']} - {user_name}",
             day=target_class['day'],
             time=target_class['time'],
@@ -184,21 +386,22 @@ def add_class_to_calendar(class_name: str, user_name: str) -> str:
         return f"Error adding to calendar: {e}"
 
 @mcp.tool()
-def book_and_add_to_calendar(class_name: str, user_name: str) -> str:
+async def book_and_add_to_calendar(class_name: str, user_name: str) -> str:
     """Books a class AND adds it to Google Calendar in one step.
     
     Args:
         class_name: Name of the class to book
         user_name: Name of the user
     """
+    # @mcp.tool() wraps functions in a FunctionTool, so call the underlying fn
     # First book the class
-    booking_result = book_class(class_name, user_name)
+    booking_result = book_class.fn(class_name, user_name)
     
     if "Successfully booked" not in booking_result:
         return booking_result  # Return error if booking failed
     
     # Then add to calendar
-    calendar_result = add_class_to_calendar(class_name, user_name)
+    calendar_result = await add_class_to_calendar.fn(class_name, user_name)
     
     return f"{booking_result}\n{calendar_result}"
 
@@ -1,11 +1,22 @@
 """
 Automated Tests for Gym Assistant - Extended Version
-Tests the FastMCP tools: list_classes, book_class, cancel_booking, get_my_bookings
+Tests the FastMCP tools: list_classes, book_class, cancel_booking, get_my_bookings,
+the in-memory booking store (indexes, reloads, coalesced saves) and the agent's
+streaming and direct-response handling.
 """
 import asyncio
+import builtins
+import datetime
 import json
 import os
 import shutil
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+# agent.py creates an OpenAI client at import; the tests never reach the API
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
 
 # Test configuration
 ORIGINAL_DATA_FILE = "bookings.json"
@@ -33,6 +44,137 @@ def get_text(result):
     """Extract text from ToolResult."""
     return result.content[0].text if result.content else ""
 
+def read_data_file():
+    """Read the data file straight from disk."""
+    with open(ORIGINAL_DATA_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def write_data_file(data):
+    """Write the data file directly, as an external edit would."""
+    with open(ORIGINAL_DATA_FILE, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4)
+
+def chunk(content=None, tool_calls=None):
+    """Build a fake streaming chunk with a single choice delta."""
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(
+        content=content, tool_calls=tool_calls
+    ))])
+
+def tool_call_delta(index, id=None, name=None, arguments=None):
+    """Build a fake (possibly partial) tool call delta."""
+    return SimpleNamespace(index=index, id=id, function=SimpleNamespace(
+        name=name, arguments=arguments
+    ))
+
+def fake_openai_client(turns, calls):
+    """
+    Fake AsyncOpenAI client: each completion streams the next list of chunks
+    in 'turns' and records its kwargs in 'calls'.
+    """
+    async def create(**kwargs):
+        chunks = turns[len(calls)]
+        calls.append(kwargs)
+        async def stream():
+            for c in chunks:
+                yield c
+        return stream()
+
+    async def list_models():
+        return []
+
+    return SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=create)),
+        models=SimpleNamespace(list=list_models)
+    )
+class FakeRequest:
+    """Fake Google API request whose execute() returns a fixed response."""
+    def __init__(self, response=None, on_execute=None):
+        self.response = response
+        self.on_execute = on_execute
+
+    def execute(self):
+        if self.on_execute:
+            self.on_execute()
+        return self.response
+
+def fake_calendar_service(events, deleted):
+    """
+    Fake Calendar service listing 'events' and recording deleted event ids
+    in 'deleted', both for single requests and batches.
+    """
+    def delete(calendarId, eventId):
+        return FakeRequest(on_execute=lambda: deleted.append(eventId))
+
+    def new_batch(callback):
+        requests = []
+        def execute():
+            for request, request_id in requests:
+                request.execute()
+                callback(request_id, None, None)
+        return SimpleNamespace(
+            add=lambda request, request_id: requests.append((request, request_id)),
+            execute=execute
+        )
+
+    events_api = SimpleNamespace(
+        list=lambda **kwargs: FakeRequest({"items": events}),
+        delete=delete
+    )
+    return SimpleNamespace(events=lambda: events_api, new_batch_http_request=new_batch)
+
+# Run in a separate process: save the data file repeatedly, as another
+# instance of the server would
+CONCURRENT_WRITER = """
+import sys
+import gym_server
+data = gym_server.load_data()
+for i in range(int(sys.argv[1])):
+    data[0]["slots"] = i
+    gym_server.save_data(data)
+"""
+
+# Fixed "now" for the token tests, as a naive UTC datetime like google-auth uses
+TOKEN_NOW = datetime.datetime(2025, 1, 6, 10, 0, 0)
+
+class FakeCredentials:
+    """Stand-in for google.oauth2 Credentials with a fixed expiry."""
+    def __init__(self, expires_in, token="token", refresh_token="refresh"):
+        self.token = token
+        self.refresh_token = refresh_token
+        self.expiry = TOKEN_NOW + expires_in
+        self.refreshed = 0
+
+    @property
+    def expired(self):
+        return self.expiry <= TOKEN_NOW
+
+    def refresh(self, request):
+        self.refreshed += 1
+        self.expiry = TOKEN_NOW + datetime.timedelta(hours=1)
+
+    def to_json(self):
+        # No client_id/client_secret, so it cannot be copied
+        return json.dumps({"token": self.token})
+
+class FakeThreading:
+    """Records the timers and threads calendar_service starts instead of running them."""
+    def __init__(self):
+        self.timers = []
+        self.threads = []
+        self.RLock = threading.RLock
+
+    def Timer(self, delay, function):
+        timer = SimpleNamespace(delay=delay, cancelled=False, daemon=False, start=lambda: None)
+        timer.cancel = lambda: setattr(timer, "cancelled", True)
+        self.timers.append(timer)
+        return timer
+
+    def Thread(self, target, daemon=False):
+        thread = SimpleNamespace(target=target, start=lambda: None)
+        self.threads.append(thread)
+        return thread
+
+
 async def run_tests():
     """Run all tests."""
     # Import after setting up test data
@@ -192,6 +334,550 @@ async def run_tests():
         print(f"  ✗ FAILED: {e}")
         results["failed"] += 1
     
+    # Test 13: Indexes follow book/cancel
+    print("\n[TEST 13] book_class/cancel_booking - Index upkeep")
+    try:
+        import gym_server
+        await tools['book_class'].run(arguments={"class_name": "Yoga", "user_name": "IndexUser"})
+        assert gym_server._BY_CLASS.get("yoga") == 0, f"Expected 'yoga' -> 0, got: {gym_server._BY_CLASS}"
+        assert gym_server._BY_USER.get("IndexUser") == {0}, f"Expected IndexUser -> {{0}}, got: {gym_server._BY_USER}"
+        await tools['cancel_booking'].run(arguments={"class_name": "Yoga", "user_name": "IndexUser"})
+        assert not gym_server._BY_USER.get("IndexUser"), f"Expected no index entry, got: {gym_server._BY_USER}"
+        result = await tools['get_my_bookings'].run(arguments={"user_name": "IndexUser"})
+        assert "no bookings" in get_text(result).lower(), f"Expected no bookings, got: {get_text(result)}"
+        print("  ✓ PASSED: class and user indexes stay in sync")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    
+    # Test 14: Rapid changes are coalesced into one save
+    print("\n[TEST 14] flush_changes - Coalesced saves")
+    try:
+        import gym_server
+        gym_server.flush_changes()
+        original_save = gym_server.save_data
+        saves = []
+        def counting_save(data):
+            saves.append(1)
+            original_save(data)
+        gym_server.save_data = counting_save
+        try:
+            await tools['book_class'].run(arguments={"class_name": "Yoga", "user_name": "Burst"})
+            await tools['cancel_booking'].run(arguments={"class_name": "Yoga", "user_name": "Burst"})
+            await tools['book_class'].run(arguments={"class_name": "Yoga", "user_name": "Burst"})
+            assert not saves, f"Expected no save before the flush interval, got {len(saves)}"
+            time.sleep(gym_server.FLUSH_INTERVAL * 5)
+        finally:
+            gym_server.save_data = original_save
+        assert len(saves) == 1, f"Expected exactly one save, got {len(saves)}"
+        assert "Burst" in read_data_file()[0]["booked_by"], "Expected the booking on disk after the flush"
+        print("  ✓ PASSED: a burst of changes is written once")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    
+    # Test 15: Bookings survive a restart
+    print("\n[TEST 15] load_data - Bookings persist across restarts")
+    try:
+        import gym_server
+        gym_server.flush_changes()
+        # Simulate a fresh process: drop the in-memory copy
+        gym_server._DATA = None
+        result = await tools['get_my_bookings'].run(arguments={"user_name": "Burst"})
+        text = get_text(result)
+        assert "Yoga" in text, f"Expected Yoga after reload, got: {text}"
+        print("  ✓ PASSED: saved bookings are loaded again")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    
+    # Test 16: External edits are picked up without losing bookings
+    print("\n[TEST 16] load_data - Reload after external edit")
+    try:
+        import gym_server
+        gym_server.flush_changes()
+        data = read_data_file()
+        data.append({"class_name": "Zumba", "day": "Friday", "time": "18:00", "slots": 5, "booked_by": []})
+        write_data_file(data)
+        result = await tools['list_classes'].run(arguments={})
+        text = get_text(result)
+        assert "Zumba" in text, f"Expected externally added class, got: {text}"
+        result = await tools['get_my_bookings'].run(arguments={"user_name": "Burst"})
+        assert "Yoga" in get_text(result), f"Expected saved booking kept, got: {get_text(result)}"
+        print("  ✓ PASSED: external edits are reloaded and saved bookings kept")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    
+    # Test 17: Unsaved bookings survive an external edit
+    print("\n[TEST 17] load_data - Pending changes re-applied after external edit")
+    try:
+        import gym_server
+        gym_server.flush_changes()
+        original_interval = gym_server.FLUSH_INTERVAL
+        gym_server.FLUSH_INTERVAL = 60
+        try:
+            await tools['book_class'].run(arguments={"class_name": "Zumba", "user_name": "Pending"})
+        finally:
+            gym_server.FLUSH_INTERVAL = original_interval
+        # Another process adds a class before our change is saved
+        data = read_data_file()
+        data.insert(0, {"class_name": "Boxeo", "day": "Monday", "time": "20:00", "slots": 5, "booked_by": []})
+        write_data_file(data)
+        result = await tools['get_my_bookings'].run(arguments={"user_name": "Pending"})
+        assert "Zumba" in get_text(result), f"Expected pending booking kept, got: {get_text(result)}"
+        gym_server.flush_changes()
+        on_disk = {c["class_name"]: c for c in read_data_file()}
+        assert "Boxeo" in on_disk, "Expected the external class to be kept on disk"
+        assert "Pending" in on_disk["Zumba"]["booked_by"], "Expected the pending booking on disk"
+        print("  ✓ PASSED: unsaved bookings are merged into the edited file")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    
+    # Test 18: Streaming reassembles content and tool calls
+    print("\n[TEST 18] agent._stream_completion - Delta reassembly")
+    try:
+        import agent
+        calls = []
+        agent.client = fake_openai_client([[
+            chunk(content="Let me "),
+            chunk(content="check."),
+            chunk(tool_calls=[tool_call_delta(0, id="call_a", name="list_", arguments="")]),
+            chunk(tool_calls=[tool_call_delta(1, id="call_b", name="get_my_bookings", arguments='{"user_')]),
+            chunk(tool_calls=[tool_call_delta(0, name="classes", arguments="{}")]),
+            chunk(tool_calls=[tool_call_delta(1, arguments='name": "Alice"}')]),
+        ]], calls)
+        msg = await agent._stream_completion(model="test", messages=[])
+        assert msg["content"] == "Let me check.", f"Unexpected content: {msg['content']}"
+        names = [tc["function"]["name"] for tc in msg["tool_calls"]]
+        assert names == ["list_classes", "get_my_bookings"], f"Unexpected tool names: {names}"
+        args = json.loads(msg["tool_calls"][1]["function"]["arguments"])
+        assert args == {"user_name": "Alice"}, f"Unexpected arguments: {args}"
+        assert [tc["id"] for tc in msg["tool_calls"]] == ["call_a", "call_b"], "Unexpected tool call ids"
+        print("  ✓ PASSED: streamed deltas are reassembled in order")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    
+    # Test 19: Direct response only when the model marks the final answer
+    print("\n[TEST 19] agent._run_tool_call - Direct response")
+    try:
+        import agent
+        def call(name, arguments):
+            return {"id": "call_1", "function": {"name": name, "arguments": json.dumps(arguments)}}
+        _, text = await agent._run_tool_call(call("list_classes", {"final_answer": True}), tools)
+        assert text and text.startswith("Available Classes:"), f"Expected formatted classes, got: {text}"
+        _, text = await agent._run_tool_call(call("list_classes", {}), tools)
+        assert text is None, f"Expected no direct text without final_answer, got: {text}"
+        _, text = await agent._run_tool_call(call("get_my_bookings", {"user_name": "", "final_answer": True}), tools)
+        assert text is None, f"Expected errors to go back to the model, got: {text}"
+        _, text = await agent._run_tool_call(call("book_class", {"class_name": "Yoga", "user_name": "X", "final_answer": True}), tools)
+        assert text is None, f"Expected no direct text for non-direct tools, got: {text}"
+        await tools['cancel_booking'].run(arguments={"class_name": "Yoga", "user_name": "X"})
+        print("  ✓ PASSED: direct responses require a direct tool and final_answer")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    
+    # Test 20: Direct tools do not cut off a list-then-book chain
+    print("\n[TEST 20] agent.main - Tool chaining after a direct tool")
+    original_input = builtins.input
+    try:
+        import agent
+        agent.TOOLS_CACHE_FILE = os.path.join(tempfile.mkdtemp(), "tools_cache.json")
+        calls = []
+        agent.client = fake_openai_client([
+            [chunk(tool_calls=[tool_call_delta(0, id="c1", name="list_classes", arguments="{}")])],
+            [chunk(tool_calls=[tool_call_delta(0, id="c2", name="book_class",
+                                               arguments='{"class_name": "Zumba", "user_name": "Chain"}')])],
+            [chunk(content="Booked Zumba for Chain.")],
+            [chunk(tool_calls=[tool_call_delta(0, id="c3", name="get_my_bookings",
+                                               arguments='{"user_name": "Chain", "final_answer": true}')])],
+        ], calls)
+        inputs = iter(["List classes and book me the first one", "What are my bookings?", "quit"])
+        builtins.input = lambda prompt="": next(inputs)
+        await agent.main()
+        assert len(calls) == 4, f"Expected 3 LLM calls for the chain and 1 for the direct answer, got {len(calls)}"
+        assert calls[0]["parallel_tool_calls"] is True, "Expected parallel tool calls enabled"
+        result = await tools['get_my_bookings'].run(arguments={"user_name": "Chain"})
+        assert "Zumba" in get_text(result), f"Expected the chained booking, got: {get_text(result)}"
+        print("  ✓ PASSED: chains continue and final answers skip the follow-up call")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    finally:
+        builtins.input = original_input
+    
+    # Test 21: Deleting by title removes only the first match by default
+    print("\n[TEST 21] delete_event_by_title - First match unless delete_all")
+    import calendar_service
+    original_get_service = calendar_service.get_calendar_service
+    try:
+        events = [
+            {"id": "e1", "summary": "Gym: Yoga"},
+            {"id": "e2", "summary": "Dentist"},
+            {"id": "e3", "summary": "Gym: Pilates"},
+        ]
+        deleted = []
+        calendar_service.get_calendar_service = lambda: fake_calendar_service(events, deleted)
+        text = calendar_service.delete_event_by_title("gym")
+        assert deleted == ["e1"], f"Expected only the first match deleted, got: {deleted}"
+        assert text == "Deleted event: Gym: Yoga", f"Unexpected message: {text}"
+        deleted.clear()
+        text = calendar_service.delete_event_by_title("gym", delete_all=True)
+        assert deleted == ["e1", "e3"], f"Expected every match deleted, got: {deleted}"
+        assert "Gym: Yoga" in text and "Gym: Pilates" in text, f"Unexpected message: {text}"
+        deleted.clear()
+        text = calendar_service.delete_event_by_title("swim")
+        assert not deleted and "No event found" in text, f"Expected nothing deleted, got: {deleted}"
+        print("  ✓ PASSED: delete_event_by_title only deletes every match on request")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    finally:
+        calendar_service.get_calendar_service = original_get_service
+    
+    # Test 22: Malformed tool arguments don't fail the whole round
+    print("\n[TEST 22] agent._run_tool_call - Invalid arguments")
+    try:
+        import agent
+        round_calls = [
+            {"id": "ok", "function": {"name": "book_class",
+                                      "arguments": '{"class_name": "Zumba", "user_name": "Sibling"}'}},
+            {"id": "bad_json", "function": {"name": "book_class", "arguments": '{"class_name": '}},
+            {"id": "not_object", "function": {"name": "book_class", "arguments": '["Zumba"]'}},
+        ]
+        tool_results = await asyncio.gather(*(agent._run_tool_call(tc, tools) for tc in round_calls))
+        replies = {msg["tool_call_id"]: msg["content"] for msg, _ in tool_results}
+        assert list(replies) == ["ok", "bad_json", "not_object"], f"Expected a reply per call, got: {list(replies)}"
+        assert "Successfully booked" in replies["ok"], f"Expected the valid call to run, got: {replies['ok']}"
+        for call_id in ("bad_json", "not_object"):
+            assert replies[call_id].startswith("Error: invalid arguments"), f"Unexpected reply: {replies[call_id]}"
+        await tools['cancel_booking'].run(arguments={"class_name": "Zumba", "user_name": "Sibling"})
+        print("  ✓ PASSED: invalid arguments become error replies")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    
+    # Test 23: Ctrl+C at the prompt ends the CLI cleanly
+    print("\n[TEST 23] agent.main - Ctrl+C at the prompt")
+    original_input = builtins.input
+    release = threading.Event()
+    try:
+        import agent
+        prompted = threading.Event()
+        def blocking_input(prompt=""):
+            prompted.set()
+            release.wait()
+            return "quit"
+        builtins.input = blocking_input
+        main_task = asyncio.create_task(agent.main())
+        assert await asyncio.to_thread(prompted.wait, 5), "Expected main() to prompt for input"
+        # asyncio.run turns Ctrl+C into a cancellation of the main task
+        main_task.cancel()
+        await asyncio.wait_for(main_task, 5)
+        assert not main_task.cancelled(), "Expected main() to return instead of propagating the cancellation"
+        print("  ✓ PASSED: main() exits without a traceback while waiting for input")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    finally:
+        release.set()
+        builtins.input = original_input
+    
+    # Test 24: Concurrent writers never leave a corrupt or half-written file
+    print("\n[TEST 24] save_data - Concurrent writers")
+    try:
+        import gym_server
+        import subprocess
+        import sys
+        gym_server.flush_changes()
+        before = read_data_file()
+        writers = [
+            subprocess.Popen([sys.executable, "-c", CONCURRENT_WRITER, "100"],
+                             cwd=gym_server.SCRIPT_DIR, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            for _ in range(4)
+        ]
+        outputs = [w.communicate()[0].decode() for w in writers]
+        errors = [line for out in outputs for line in out.splitlines() if "Error saving data" in line]
+        assert not errors, f"Expected every save to succeed, got: {errors[:3]}"
+        after = read_data_file()
+        assert [c["class_name"] for c in after] == [c["class_name"] for c in before], "Expected the same classes after the writes"
+        leftovers = [f for f in os.listdir(gym_server.SCRIPT_DIR) if f.startswith("bookings.json") and f.endswith(".tmp")]
+        assert not leftovers, f"Expected no temp files left behind, got: {leftovers}"
+        write_data_file(before)
+        print("  ✓ PASSED: concurrent saves each replace the file with a complete snapshot")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    
+    # Test 25: Snapshots are synced to disk before they replace the file
+    print("\n[TEST 25] save_data - fsync before replace")
+    original_fsync, original_replace = os.fsync, os.replace
+    try:
+        import gym_server
+        gym_server.flush_changes()
+        steps = []
+        def recording_fsync(fd):
+            steps.append("fsync")
+            original_fsync(fd)
+        def recording_replace(src, dst):
+            steps.append("replace")
+            original_replace(src, dst)
+        os.fsync, os.replace = recording_fsync, recording_replace
+        try:
+            gym_server.save_data(gym_server.load_data())
+        finally:
+            os.fsync, os.replace = original_fsync, original_replace
+        assert steps == ["fsync", "replace"], f"Expected fsync before replace, got: {steps}"
+        print("  ✓ PASSED: the temp file is synced before it is moved into place")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    
+    # Test 26: A pending booking is dropped if the class filled up meanwhile
+    print("\n[TEST 26] load_data - No overbooking when re-applying pending bookings")
+    try:
+        import gym_server
+        gym_server.flush_changes()
+        data = read_data_file()
+        data.append({"class_name": "Spinning", "day": "Tuesday", "time": "19:00", "slots": 1, "booked_by": []})
+        write_data_file(data)
+        original_interval = gym_server.FLUSH_INTERVAL
+        gym_server.FLUSH_INTERVAL = 60
+        try:
+            result = await tools['book_class'].run(arguments={"class_name": "Spinning", "user_name": "Late"})
+            assert "Successfully booked" in get_text(result), f"Expected the booking to succeed, got: {get_text(result)}"
+        finally:
+            gym_server.FLUSH_INTERVAL = original_interval
+        # Another process takes the last slot before our booking is saved
+        data[-1]["booked_by"] = ["Early"]
+        write_data_file(data)
+        result = await tools['get_my_bookings'].run(arguments={"user_name": "Late"})
+        assert "Spinning" not in get_text(result), f"Expected the pending booking dropped, got: {get_text(result)}"
+        gym_server.flush_changes()
+        spinning = read_data_file()[-1]
+        assert spinning["booked_by"] == ["Early"], f"Expected only the other process's booking, got: {spinning['booked_by']}"
+        print("  ✓ PASSED: a class filled by someone else is not overbooked")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    
+    # Test 27: A failed save is retried
+    print("\n[TEST 27] flush_changes - Retry after a failed save")
+    try:
+        import gym_server
+        gym_server.flush_changes()
+        original_save = gym_server.save_data
+        original_retry = gym_server.FLUSH_RETRY_INTERVAL
+        attempts = []
+        def failing_once_save(data):
+            attempts.append(1)
+            if len(attempts) == 1:
+                print("Error saving data: simulated failure")
+                return
+            original_save(data)
+        gym_server.save_data = failing_once_save
+        gym_server.FLUSH_RETRY_INTERVAL = gym_server.FLUSH_INTERVAL
+        try:
+            await tools['book_class'].run(arguments={"class_name": "Zumba", "user_name": "Retry"})
+            deadline = time.time() + 2
+            while len(attempts) < 2 and time.time() < deadline:
+                time.sleep(gym_server.FLUSH_INTERVAL)
+        finally:
+            gym_server.save_data = original_save
+            gym_server.FLUSH_RETRY_INTERVAL = original_retry
+        assert len(attempts) == 2, f"Expected the save to be retried once, got {len(attempts)} attempts"
+        zumba = next(c for c in read_data_file() if c["class_name"] == "Zumba")
+        assert "Retry" in zumba["booked_by"], "Expected the booking on disk after the retry"
+        await tools['cancel_booking'].run(arguments={"class_name": "Zumba", "user_name": "Retry"})
+        gym_server.flush_changes()
+        print("  ✓ PASSED: unsaved changes are saved on the next attempt")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    
+    # Test 28: Token state and background refresh scheduling
+    print("\n[TEST 28] calendar_service - Token refresh state machine")
+    import calendar_service
+    saved = {name: getattr(calendar_service, name) for name in (
+        "_CREDS", "_SERVICE", "_REFRESH_TIMER", "_REFRESH_IN_FLIGHT",
+        "_utcnow_naive", "_save_token", "threading"
+    )}
+    try:
+        calendar_service._utcnow_naive = lambda: TOKEN_NOW
+        calendar_service._save_token = lambda creds: None
+        fake_threading = FakeThreading()
+        calendar_service.threading = fake_threading
+        minutes = lambda m: datetime.timedelta(minutes=m)
+        
+        # fresh / stale / expired
+        cases = [
+            (FakeCredentials(minutes(60)), "fresh"),
+            (FakeCredentials(minutes(6)), "fresh"),
+            (FakeCredentials(minutes(5)), "stale"),
+            (FakeCredentials(minutes(1)), "stale"),
+            (FakeCredentials(minutes(0)), "expired"),
+            (FakeCredentials(minutes(-10)), "expired"),
+            (FakeCredentials(minutes(60), token=None), "expired"),
+        ]
+        for creds, expected in cases:
+            state = calendar_service._token_state(creds)
+            assert state == expected, f"Expected {expected} for expiry {creds.expiry}, got {state}"
+        
+        # The timer fires when the token becomes stale, and replaces the previous one
+        calendar_service._REFRESH_TIMER = None
+        calendar_service._schedule_refresh(FakeCredentials(minutes(60)))
+        first = fake_threading.timers[-1]
+        assert first.delay == 55 * 60, f"Expected a refresh in 55 minutes, got {first.delay}s"
+        calendar_service._schedule_refresh(FakeCredentials(minutes(2)))
+        assert first.cancelled, "Expected the previous timer to be cancelled"
+        assert fake_threading.timers[-1].delay == 0, "Expected an immediate refresh for a stale token"
+        timers = len(fake_threading.timers)
+        calendar_service._schedule_refresh(FakeCredentials(minutes(60), refresh_token=None))
+        assert len(fake_threading.timers) == timers, "Expected no timer without a refresh token"
+        
+        # get_calendar_service: only stale tokens refresh in the background, only once at a time
+        calendar_service._SERVICE = service = object()
+        calendar_service._CREDS = FakeCredentials(minutes(30))
+        assert calendar_service.get_calendar_service() is service
+        assert not fake_threading.threads, "Expected no refresh for a fresh token"
+        calendar_service._CREDS = FakeCredentials(minutes(3))
+        calendar_service._REFRESH_IN_FLIGHT = False
+        calendar_service.get_calendar_service()
+        assert len(fake_threading.threads) == 1, "Expected a background refresh for a stale token"
+        calendar_service._REFRESH_IN_FLIGHT = True
+        calendar_service.get_calendar_service()
+        assert len(fake_threading.threads) == 1, "Expected no second refresh while one is in flight"
+        calendar_service._REFRESH_IN_FLIGHT = False
+        expired = calendar_service._CREDS = FakeCredentials(minutes(-1))
+        calendar_service.get_calendar_service()
+        assert expired.refreshed == 1, "Expected an expired token to be refreshed inline"
+        
+        # A token that cannot be copied must not leave the in-flight flag set
+        calendar_service._CREDS = FakeCredentials(minutes(3))
+        calendar_service._refresh_credentials()
+        assert calendar_service._REFRESH_IN_FLIGHT is False, "Expected the in-flight flag cleared after a failed refresh"
+        print("  ✓ PASSED: tokens are refreshed at the right time, and only once at a time")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    finally:
+        for name, value in saved.items():
+            setattr(calendar_service, name, value)
+    
+    # Test 29: Changing the injected final_answer property invalidates the tools cache
+    print("\n[TEST 29] agent._tools_key - Agent-side schema changes")
+    import agent
+    original_property = agent.FINAL_ANSWER_PROPERTY
+    original_version = agent.TOOLS_SCHEMA_VERSION
+    try:
+        key = agent._tools_key(tools)
+        assert agent._tools_key(tools) == key, "Expected a stable key"
+        agent.FINAL_ANSWER_PROPERTY = {**original_property, "description": "Edited hint"}
+        assert agent._tools_key(tools) != key, "Expected a new key when the final_answer property changes"
+        agent.FINAL_ANSWER_PROPERTY = original_property
+        agent.TOOLS_SCHEMA_VERSION = original_version + 1
+        assert agent._tools_key(tools) != key, "Expected a new key when the schema version changes"
+        print("  ✓ PASSED: the cache key covers what agent.py adds to the schemas")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    finally:
+        agent.FINAL_ANSWER_PROPERTY = original_property
+        agent.TOOLS_SCHEMA_VERSION = original_version
+    
+    # Test 30: get_my_bookings reads the data and the user index under the lock
+    print("\n[TEST 30] get_my_bookings - Consistent with concurrent reloads")
+    import gym_server
+    original_load = gym_server.load_data
+    reloads = []
+    try:
+        gym_server.flush_changes()
+        def racing_load():
+            data = original_load()
+            # Right after the load, the flush thread picks up an external edit
+            # that removed the first class, shifting every index
+            def reload():
+                with gym_server._DATA_LOCK:
+                    gym_server._DATA = data[1:]
+                    gym_server._build_indexes(gym_server._DATA)
+            reloader = threading.Thread(target=reload)
+            reloader.start()
+            reloader.join(0.2)
+            reloads.append(reloader)
+            return data
+        gym_server.load_data = racing_load
+        result = await tools['get_my_bookings'].run(arguments={"user_name": "Alice"})
+        text = get_text(result)
+        assert "Pilates" in text and "Yoga" not in text, f"Expected Alice's Pilates booking, got: {text}"
+        print("  ✓ PASSED: get_my_bookings never mixes old data with a new index")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    finally:
+        gym_server.load_data = original_load
+        for reloader in reloads:
+            reloader.join()
+        # Back to the data on disk
+        gym_server._DATA = None
+        gym_server.load_data()
+    
+    # Test 31: The weekday table matches the old days_ahead calculation
+    print("\n[TEST 31] calendar_service - _NEXT_OCCURRENCE table")
+    try:
+        import calendar_service
+        for today in range(7):
+            for target in range(7):
+                days_ahead = target - today
+                if days_ahead <= 0:
+                    days_ahead += 7
+                got = calendar_service._NEXT_OCCURRENCE[today][target]
+                assert got == days_ahead, f"today={today} target={target}: expected {days_ahead}, got {got}"
+        print("  ✓ PASSED: all 49 weekday pairs match")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    
+    # Test 32: _parse_time accepts the same times as the old split parsing
+    print("\n[TEST 32] calendar_service - _parse_time")
+    try:
+        import calendar_service
+        for text in ["10:00", "09:30", "9:30", "23:59", "0:05", "7:00"]:
+            expected = tuple(map(int, text.split(':')))
+            got = calendar_service._parse_time(text)
+            assert got == expected, f"{text!r}: expected {expected}, got {got}"
+        try:
+            calendar_service._parse_time("10:00:00")
+            raise AssertionError("Expected ValueError for '10:00:00'")
+        except ValueError:
+            pass
+        print("  ✓ PASSED: 'HH:MM' and 'H:MM' parse as before")
+        results["passed"] += 1
+    except Exception as e:
+        print(f"  ✗ FAILED: {e}")
+        results["failed"] += 1
+    
     # Summary
     print("\n" + "=" * 50)
     print(f"TEST RESULTS: {results['passed']} passed, {results['failed']} failed")
@@ -207,6 +893,9 @@ if __name__ == "__main__":
     try:
         success = asyncio.run(run_tests())
     finally:
+        # Save pending bookings to the test file before the original comes back
+        from gym_server import flush_changes
+        flush_changes()
         restore_data()
         print("\nTest data cleaned up.")
     